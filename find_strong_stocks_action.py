@@ -2,24 +2,59 @@
 # Single-run version for GitHub Actions (runs once and exits)
 # Reads TELEGRAM_TOKEN and TELEGRAM_CHAT_ID from environment variables.
 
+import io
 import os
-import time
-import math
+import re
+import asyncio
+import httpx
+import orjson
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from datetime import datetime, time, timedelta, timezone
+import numpy as np
 import pandas as pd
 import yfinance as yf
+import matplotlib
+matplotlib.use("Agg")  # headless; must be set before mplfinance imports pyplot
 import mplfinance as mpf
+from numba import njit
 
 # Config (no hardcode token here; use env variables via GitHub Secrets)
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID")
 WORKDIR = "strong_output"
 CHART_DIR = os.path.join(WORKDIR, "charts")
+SAVE_CHARTS = os.environ.get("SAVE_CHARTS") == "1"  # also keep PNGs under CHART_DIR
+CACHE_DIR = os.path.join(WORKDIR, "cache")
 os.makedirs(WORKDIR, exist_ok=True)
 os.makedirs(CHART_DIR, exist_ok=True)
+os.makedirs(CACHE_DIR, exist_ok=True)
 
 TWSE_URL = "https://www.twse.com.tw/exchangeReport/MI_INDEX?response=json&type=ALLBUT0999"
+HISTORY_PERIOD = "3mo"  # ~63 bars: MA60 + 10-day high + 3 volume bars
+FALLBACK_PERIOD = "6mo"
+MIN_BARS = 60
+DOWNLOAD_CHUNK = 20  # tickers per yf.download request (keeps Yahoo URLs short)
+ANALYSIS_WORKERS = 8
+MAX_CHARTS = 5  # Telegram photos sent per run
+CACHE_MAX_BARS = 120  # trim cached history so it doesn't grow forever
+TAIPEI_TZ = timezone(timedelta(hours=8))
+MARKET_CLOSE = time(14, 30)  # TWSE closes 13:30; give Yahoo an hour to settle the bar
+
+# (key, TWSE column token) for the columns extract_top300 keeps, in output order
+NEEDED = (("code","證券代號"),("name","證券名稱"),("vol","成交股數"),("close","收盤價"))
+EXCLUDE_KEYWORDS = ["ETF", "權證", "DR", "受益證券", "基金", "富邦", "元大", "國泰", "群益", "永豐", "台新", "銀行", "金控", "金融", "證券", "保險"]
+_EXCLUDE_RE = re.compile("|".join(map(re.escape, EXCLUDE_KEYWORDS)))
+_HTML_TAG_RE = re.compile(r"<.*?>")
+
+# Keep-alive session with retry/backoff for TWSE requests
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3)))
+
+# One HTTP/2 connection to api.telegram.org reused for every text message
+_client = httpx.Client(http2=True, timeout=30)
 
 def telegram_send_text(text: str):
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
@@ -28,30 +63,41 @@ def telegram_send_text(text: str):
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     payload = {"chat_id": TELEGRAM_CHAT_ID, "text": text, "parse_mode": "HTML"}
     try:
-        r = requests.post(url, data=payload, timeout=15)
-        return r.ok, r.text
+        r = _client.post(url, data=payload, timeout=15)
+        return r.is_success, r.text
     except Exception as e:
         return False, str(e)
 
-def telegram_send_photo(path):
-    if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
-        print("Telegram token/chat id not set; skipping photo send.")
-        return False, "no-token"
+async def _send_photo(client, photo):
+    # photo: PNG bytes, or a path to an image file on disk
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendPhoto"
     try:
-        with open(path, "rb") as f:
-            files = {"photo": f}
-            data = {"chat_id": TELEGRAM_CHAT_ID}
-            r = requests.post(url, files=files, data=data, timeout=30)
-        return r.ok, r.text
+        if isinstance(photo, (bytes, bytearray)):
+            files = {"photo": ("chart.png", photo, "image/png")}
+        else:
+            with open(photo, "rb") as f:
+                files = {"photo": (os.path.basename(photo), f.read(), "image/png")}
+        data = {"chat_id": TELEGRAM_CHAT_ID}
+        r = await client.post(url, files=files, data=data)
+        return r.is_success, r.text
     except Exception as e:
         return False, str(e)
 
+def telegram_send_photos(photos):
+    # Uploads run concurrently over a single multiplexed connection
+    if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
+        print("Telegram token/chat id not set; skipping photo send.")
+        return [(False, "no-token") for _ in photos]
+    async def send_all():
+        async with httpx.AsyncClient(http2=True, timeout=30) as client:
+            return await asyncio.gather(*(_send_photo(client, p) for p in photos))
+    return asyncio.run(send_all())
+
 def fetch_twse_table():
     try:
-        r = requests.get(TWSE_URL, timeout=20)
+        r = SESSION.get(TWSE_URL, timeout=20)
         r.raise_for_status()
-        js = r.json()
+        js = orjson.loads(r.content)
     except Exception as e:
         return None, f"TWSE fetch failed: {e}"
 
@@ -74,101 +120,203 @@ def fetch_twse_table():
     return None, "No suitable table structure found in TWSE JSON."
 
 def extract_top300(df_raw):
-    df = df_raw.copy()
-    df.columns = [c.strip() for c in df.columns]
-
-    col_map = {}
-    for c in df.columns:
-        if "證券代號" in c: col_map["code"]=c
-        if "證券名稱" in c: col_map["name"]=c
-        if "成交股數" in c: col_map["vol"]=c
-        if "收盤價" in c: col_map["close"]=c
-
-    if not all(k in col_map for k in ["code","name","vol","close"]):
-        return None, f"Missing columns; found {list(col_map.keys())}"
-
-    df = df[[col_map["code"], col_map["name"], col_map["vol"], col_map["close"]]].copy()
-    df.columns = ["證券代號","證券名稱","成交股數","收盤價"]
-    df["證券名稱"] = df["證券名稱"].astype(str).str.replace(r"<.*?>","",regex=True).str.strip()
-    df["證券代號"] = df["證券代號"].astype(str).str.strip()
-
-    def to_num(x):
-        s = str(x).replace(",","").replace("--","0").strip()
-        try: return float(s)
-        except: return 0.0
-    df["成交股數"] = df["成交股數"].apply(to_num)
-    def to_price(x):
-        s = str(x).replace(",","").replace("--","0").strip()
-        try: return float(s)
-        except: return float("nan")
-    df["收盤價"] = df["收盤價"].apply(to_price)
-
-    exclude_name_keywords = ["ETF", "權證", "DR", "受益證券", "基金", "富邦", "元大", "國泰", "群益", "永豐", "台新", "銀行", "金控", "金融", "證券", "保險"]
-    mask = ~df["證券名稱"].str.contains("|".join(exclude_name_keywords), na=False)
-    df = df[mask].copy()
-    df = df.sort_values("成交股數", ascending=False).head(300).reset_index(drop=True)
+    # first raw column containing each token (TWSE headers may carry extra whitespace)
+    col_map = {key: next((c for c in df_raw.columns if tok in c), None) for key,tok in NEEDED}
+    missing = [tok for key,tok in NEEDED if col_map[key] is None]
+    if missing:
+        return None, f"Missing columns {missing}; found {list(df_raw.columns)}"
+
+    # Column selection already copies df_raw; rename that frame in place
+    df = df_raw[[col_map[key] for key,_ in NEEDED]]
+    df.columns = [tok for _,tok in NEEDED]
+    # Arrow-backed strings so strip/replace/contains run as Arrow compute kernels.
+    # Those take pattern strings (RE2), not compiled re objects, hence .pattern below.
+    df = df.astype({"證券代號":"string[pyarrow]", "證券名稱":"string[pyarrow]"})
+    df["證券名稱"] = df["證券名稱"].str.replace(_HTML_TAG_RE.pattern,"",regex=True).str.strip()
+    df["證券代號"] = df["證券代號"].str.strip()
+
+    def clean_num(col):
+        s = df[col].astype("string").str.replace(",","",regex=False).str.strip()
+        s = s.mask(s.eq("--").fillna(False), "0")  # leave <NA> cells missing
+        # to_numeric on "string" dtype gives nullable Int64/Float64; keep plain float64/NaN
+        return pd.to_numeric(s, errors="coerce").astype("float64")
+    df["成交股數"] = clean_num("成交股數").fillna(0.0)
+    df["收盤價"] = clean_num("收盤價")
+
+    mask = ~df["證券名稱"].str.contains(_EXCLUDE_RE.pattern, na=False)
+    df = df[mask].nlargest(300, "成交股數").reset_index(drop=True)
     df["成交張數"] = (df["成交股數"] / 1000.0).round(3)
-    df.to_csv(os.path.join(WORKDIR,"top_volume_stocks.csv"), index=False, encoding="utf-8-sig")
+    df.to_parquet(os.path.join(WORKDIR,"top_volume_stocks.parquet"), engine="pyarrow", compression="zstd", index=False)
     return df, None
 
-def is_strong_stock(symbol_plain, name):
-    symbol = symbol_plain + ".TW"
+def download_history(symbols, period=HISTORY_PERIOD):
+    # Batch Yahoo requests: one multi-ticker call per chunk instead of one per symbol
+    history = {}
+    chunks = [symbols[i:i+DOWNLOAD_CHUNK] for i in range(0, len(symbols), DOWNLOAD_CHUNK)]
+    for chunk in chunks:
+        try:
+            data = yf.download(chunk, period=period, interval="1d", group_by="ticker", threads=True, progress=False)
+        except Exception as e:
+            print(f"download failed for {chunk[0]}..{chunk[-1]}: {e}")
+            continue
+        if data is None or data.empty:
+            continue
+        for sym in chunk:
+            if isinstance(data.columns, pd.MultiIndex):
+                if sym not in data.columns.get_level_values(0):
+                    continue
+                df = data[sym]
+            else:
+                df = data
+            df = df.dropna(how="all")
+            if not df.empty:
+                history[sym] = df
+    return history
+
+def last_closed_session():
+    # Most recent weekday whose TWSE session has closed (holidays aren't known; they just refetch)
+    now = datetime.now(TAIPEI_TZ)
+    d = now.date()
+    if now.time() < MARKET_CLOSE:
+        d -= timedelta(days=1)
+    while d.weekday() >= 5:
+        d -= timedelta(days=1)
+    return d
+
+def cache_is_current(path, cached):
+    # Current only if the last bar is the latest closed session and was written after
+    # that close; a file written mid-session holds a partial bar for that day.
+    session = last_closed_session()
+    closed_at = datetime.combine(session, MARKET_CLOSE, TAIPEI_TZ).timestamp()
+    return cached.index[-1].date() == session and os.path.getmtime(path) >= closed_at
+
+def delta_extends(cached, delta):
+    # The delta must overlap the cache (no missing sessions in between) and agree on
+    # Close for the shared bars: auto_adjust rescales history after dividends/splits.
+    # The cached last bar may have been partial, so it isn't compared.
+    if delta.index[0] > cached.index[-1]:
+        return False
+    overlap = cached.index[:-1].intersection(delta.index)
+    if overlap.empty:
+        return False
+    return np.allclose(cached.loc[overlap, "Close"], delta.loc[overlap, "Close"], rtol=1e-4, equal_nan=True)
+
+def load_history(symbols, period=HISTORY_PERIOD):
+    # Current cache: use as-is. Stale: fetch only the last 5d and merge, falling back to a
+    # full download when the delta doesn't line up. Missing: full download.
+    # Cache files live in CACHE_DIR/{symbol}.parquet.
+    history = {}
+    stale = {}
+    missing = []
+    for sym in symbols:
+        path = os.path.join(CACHE_DIR, f"{sym}.parquet")
+        if not os.path.exists(path):
+            missing.append(sym)
+            continue
+        try:
+            cached = pd.read_parquet(path)
+        except Exception:
+            missing.append(sym)
+            continue
+        if cached.empty:
+            missing.append(sym)
+        elif cache_is_current(path, cached):
+            history[sym] = cached
+        else:
+            stale[sym] = cached
+
+    fresh = {}
+    delta = download_history(list(stale), period="5d")
+    for sym, cached in stale.items():
+        # no delta means the cache can't be brought up to date; never screen old bars.
+        # If the full download also fails the symbol stays out of history (no-data).
+        if sym not in delta or not delta_extends(cached, delta[sym]):
+            missing.append(sym)
+            continue
+        merged = pd.concat([cached, delta[sym]])
+        merged = merged[~merged.index.duplicated(keep="last")].sort_index()
+        fresh[sym] = merged
+
+    full = download_history(missing, period=period)
+    # "3mo" can land just under 60 bars around holidays; refetch those so MA60 has a value
+    short = [sym for sym, df in full.items() if len(df) < MIN_BARS]
+    if short:
+        full.update(download_history(short, period=FALLBACK_PERIOD))
+    fresh.update(full)
+
+    for sym, df in fresh.items():
+        df = df.tail(CACHE_MAX_BARS)
+        try:
+            df.to_parquet(os.path.join(CACHE_DIR, f"{sym}.parquet"), compression="zstd")
+        except Exception as e:
+            print(f"cache write failed for {sym}: {e}")
+        history[sym] = df
+    return history
+
+# Screens in evaluation order, cheapest / most selective first
+CONDITIONS = ("cond_pct", "cond_vols_up", "cond_close_above_ma5", "cond_close_new10", "cond_yesterday_vs_ma5")
+
+@njit(cache=True)
+def evaluate_conditions(close, volume):
+    # Returns (number of CONDITIONS passed before the first failure, pct); needs len(close) >= 10
+    close_today = close[-1]
+    prev_close = close[-2]
+    pct = (close_today - prev_close) / prev_close * 100.0
+    if not pct > 3.0:
+        return 0, pct
+    if not (volume[-3] < volume[-2] and volume[-2] < volume[-1]):
+        return 1, pct
+    if not close_today > close[-5:].mean():
+        return 2, pct
+    ten_high = close[-10:].max()
+    if not ((close_today >= ten_high) or (close_today >= ten_high*0.95)):
+        return 3, pct
+    ma5_vol_prev = volume[-6:-1].mean()  # 5-day volume MA as of yesterday
+    if not volume[-2] > ma5_vol_prev * 2:
+        return 4, pct
+    return 5, pct
+
+def is_strong_stock(symbol_plain, name, data):
     try:
-        data = yf.download(symbol, period="120d", interval="1d", progress=False, threads=False)
         if data is None or data.empty or "Close" not in data.columns:
             return False, "no-data", None
-        data = data.dropna(subset=["Close"]).copy()
+        data = data.dropna(subset=["Close"])
         if "Volume" not in data.columns:
             return False, "no-volume", None
-
-        data["MA3"]=data["Close"].rolling(3).mean()
-        data["MA5"]=data["Close"].rolling(5).mean()
-        data["MA8"]=data["Close"].rolling(8).mean()
-        data["MA20"]=data["Close"].rolling(20).mean()
-        data["MA60"]=data["Close"].rolling(60).mean()
-        data["MA5_vol"]=data["Volume"].rolling(5).mean()
-
         if len(data) < 10:
             return False, "short-history", data
 
-        last_vols = data["Volume"].tail(3).values
-        cond_vols_up = len(last_vols)==3 and (last_vols[0] < last_vols[1] < last_vols[2])
-        cond_yesterday_vs_ma5 = False
-        if not math.isnan(data["MA5_vol"].iloc[-2]):
-            cond_yesterday_vs_ma5 = data["Volume"].iloc[-2] > data["MA5_vol"].iloc[-2] * 2
-        close_today = data["Close"].iloc[-1]
-        ma5_today = data["MA5"].iloc[-1]
-        cond_close_above_ma5 = (not math.isnan(ma5_today)) and (close_today > ma5_today)
-        ten_high = data["Close"].tail(10).max()
-        cond_close_new10 = (close_today >= ten_high) or (close_today >= ten_high*0.95)
-        prev_close = data["Close"].iloc[-2]
-        pct = (close_today - prev_close) / prev_close * 100.0
-        cond_pct = pct > 3.0
-
-        passed = all([cond_vols_up, cond_yesterday_vs_ma5, cond_close_above_ma5, cond_close_new10, cond_pct])
-        reason = {
-            "cond_vols_up": cond_vols_up,
-            "cond_yesterday_vs_ma5": cond_yesterday_vs_ma5,
-            "cond_close_above_ma5": cond_close_above_ma5,
-            "cond_close_new10": cond_close_new10,
-            "cond_pct": cond_pct,
-            "pct": round(pct,2)
-        }
-        return bool(passed), reason, data
+        # float64 C-contiguous in both so numba compiles (and caches) a single specialization
+        close = np.ascontiguousarray(data["Close"].to_numpy(dtype=np.float64))
+        volume = np.ascontiguousarray(data["Volume"].to_numpy(dtype=np.float64))
+        passed_n, pct = evaluate_conditions(close, volume)
+        passed = passed_n == len(CONDITIONS)
+        # only report conditions that were actually evaluated
+        reason = {c: i < passed_n for i, c in enumerate(CONDITIONS[:passed_n+1])}
+        reason["pct"] = round(float(pct),2)
+        return passed, reason, data
     except Exception as e:
         return False, f"error:{e}", None
 
+# Built once per process (chart workers inherit it) instead of per chart
+_MC = mpf.make_marketcolors(up='r', down='g', volume='r', inherit=True)
+_STYLE = mpf.make_mpf_style(marketcolors=_MC, rc={'font.sans-serif':['DejaVu Sans','Microsoft JhengHei']})
+
 def plot_chart(symbol_plain, name, data):
-    fname = os.path.join(CHART_DIR, f"{symbol_plain}_{name.replace('/','_')}.png")
+    # Renders to memory and returns the PNG bytes; the file copy is optional
     try:
         data = data.copy()
         data.index = pd.to_datetime(data.index)
-        mc = mpf.make_marketcolors(up='r', down='g', volume='r', inherit=True)
-        s = mpf.make_mpf_style(marketcolors=mc, rc={'font.sans-serif':['DejaVu Sans','Microsoft JhengHei']})
         mav=[3,5,8,20,60]
         available=[m for m in mav if len(data)>=m]
-        mpf.plot(data, type='candle', mav=available, volume=True, style=s, title=f"{symbol_plain} {name}", figsize=(10,6), savefig=dict(fname=fname,dpi=150))
-        return fname, None
+        buf = io.BytesIO()
+        mpf.plot(data, type='candle', mav=available, volume=True, style=_STYLE, title=f"{symbol_plain} {name}", figsize=(8,5), savefig=dict(fname=buf,format="png",dpi=100))
+        png = buf.getvalue()
+        if SAVE_CHARTS:
+            fname = os.path.join(CHART_DIR, f"{symbol_plain}_{name.replace('/','_')}.png")
+            with open(fname, "wb") as f:
+                f.write(png)
+        return png, None
     except Exception as e:
         return None, str(e)
 
@@ -186,29 +334,42 @@ def main():
         print("parse error:", err2)
         return
     telegram_send_text(f"📊 已取前 300 檔（排除 ETF/金融/DR），共 {len(df_top)} 檔")
+    symbols = [c + ".TW" for c in df_top["證券代號"]]
+    history = load_history(symbols)
+    # extract_top300 already stripped both columns
+    stocks = list(df_top[["證券代號","證券名稱"]].itertuples(index=False, name=None))
+    results = {}
+    with ThreadPoolExecutor(max_workers=ANALYSIS_WORKERS) as ex:
+        futures = {ex.submit(is_strong_stock, code, name, history.get(code + ".TW")): (code, name) for code, name in stocks}
+        for i, fut in enumerate(as_completed(futures)):
+            code, name = futures[fut]
+            ok, reason, hist = fut.result()
+            print(f"[{i+1}/{len(futures)}] 分析 {code} {name} ...", "✅" if ok else f"❌ {reason}")
+            results[(code, name)] = (ok, reason, hist)
+    # Keep the TWSE volume ranking order for the report, not completion order
     strong=[]
-    charts=[]
-    for i,row in df_top.iterrows():
-        code=row["證券代號"].strip()
-        name=row["證券名稱"].strip()
-        print(f"[{i+1}/{len(df_top)}] 分析 {code} {name} ...", end=" ")
-        ok, reason, hist = is_strong_stock(code, name)
+    to_plot=[]
+    can_send_photos = bool(TELEGRAM_TOKEN and TELEGRAM_CHAT_ID)
+    for code, name in stocks:
+        ok, reason, hist = results[(code, name)]
         if ok:
-            print("✅")
             strong.append((code,name,reason))
-            if hist is not None:
-                p,e = plot_chart(code,name,hist)
+            # render every chart when saving them; otherwise only the MAX_CHARTS we'll upload
+            if hist is not None and (SAVE_CHARTS or (can_send_photos and len(to_plot) < MAX_CHARTS)):
+                to_plot.append((code,name,hist))
+    charts=[]
+    if to_plot:
+        # matplotlib holds the GIL while rendering, so charts go to separate processes
+        with ProcessPoolExecutor(max_workers=min(len(to_plot), os.cpu_count() or 1)) as ex:
+            for p,e in ex.map(plot_chart, *zip(*to_plot)):
                 if p: charts.append(p)
-        else:
-            print("❌", reason)
-        time.sleep(0.6)
     if not strong:
         telegram_send_text("📈 今日無符合條件之強勢股。")
     else:
         txt = "🔥 強勢股名單：\n" + "\n".join([f"{s[0]} {s[1]}" for s in strong])
         telegram_send_text(txt)
-        for p in charts[:5]:
-            telegram_send_photo(p)
+        if charts:
+            telegram_send_photos(charts[:MAX_CHARTS])
     if strong:
         pd.DataFrame([{"symbol":s[0],"name":s[1],"reason":str(s[2])} for s in strong]).to_csv(os.path.join(WORKDIR,"strong_stocks.csv"), index=False, encoding="utf-8-sig")
 